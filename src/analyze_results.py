@@ -42,10 +42,13 @@ if __name__ == '__main__':
         batch_size = 128
 
     prefix = fnnoext.split('_')[0]
+    _, frozen_layers, early_exit = cb.parse_network_code(prefix.split('-')[-1])
 
-    _, network_path, _ = cb.parse_network_argument(args.network)
+    _, network_path, pretrained_state = cb.parse_network_argument(args.network)
 
     print(f" prefix: {prefix}")
+    print(f" frozen_layers: {frozen_layers}")
+    print(f" early_exit: {early_exit}")
     print(f" refset: {refset}")
     print(f" np_random_seed: {np_random_seed}")
     print(f" random_state: {random_state}")
@@ -57,8 +60,17 @@ if __name__ == '__main__':
 
     # load pre-trained network
     cb.Dataset.set_tokenizer(network_path)
-    model = cb.ClinicalBertClassifier(network_path)
-    model.load_state_dict(torch.load(model_filepath))
+    # early exit models are scored through the same early exit path that
+    # predict.py uses, so their valid/test outputs are softmax probabilities
+    # and the thresholds tuned on them apply to the example predictions
+    model_class = cb.EarlyExitClinicalBertClassifier if early_exit else cb.ClinicalBertClassifier
+    # legacy models keep their original head (pooler output and ReLU'd logits)
+    use_pooler = cb.uses_pooler(model_filepath)
+    model = model_class(network_path, frozen_layers=frozen_layers, use_pooler=use_pooler, relu_output=use_pooler)
+    if not pretrained_state is None:
+        # the frozen layers come from the pretrained state, not the network
+        cb.load_pretrained_state(model, pretrained_state)
+    cb.load_trainable_state(model, model_filepath)
 
     # loading and re-splitting the data
     datapath = f'./data/ref{refset}_nwords{refnwords}_clinical_bert_reference_set_{refsection}.txt'
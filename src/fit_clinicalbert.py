@@ -10,6 +10,9 @@ import sys
 import csv
 import time
 import torch
+import re
+import hashlib
+import itertools
 import random
 from torch import nn
 from torch.optim import Adam
@@ -29,40 +32,89 @@ pretrained_state_ids = {
 class Dataset(torch.utils.data.Dataset):
 
     tokenizer = None
+    tokenizer_path = None
 
     @staticmethod
     def set_tokenizer(pretrained_model_path):
         print(f"Loading ClinicalBERT tokenizer from {pretrained_model_path}...")
         Dataset.tokenizer = AutoTokenizer.from_pretrained(pretrained_model_path)
+        Dataset.tokenizer_path = pretrained_model_path
 
-    def __init__(self, df, examples_only=False, _max_length=128):
+    @staticmethod
+    def cache_path(cache_dir, strings, max_length):
+        # tokenization is deterministic, so the output is keyed by the
+        # tokenizer, the max_length, and the strings themselves
+        key = hashlib.md5()
+        key.update(f'{Dataset.tokenizer_path}|{max_length}|{len(strings)}|nopad|'.encode())
+        key.update('\n'.join(strings).encode())
+        return os.path.join(cache_dir, f'tok_{key.hexdigest()[:16]}.pt')
+
+    def __init__(self, df, examples_only=False, _max_length=128, cache_dir=None):
 
         if Dataset.tokenizer is None:
             raise Exception("ERROR: The tokenizer has not yet been initailized. Initialize with Dataset.set_tokenizer(...) before instantiating a class.")
 
         if not examples_only:
-            self.labels = [labels[label] for label in df['class']]
+            self.labels = torch.from_numpy(df['class'].map(labels).to_numpy(dtype=np.int64))
         else:
-            self.labels = [0 for _ in range(len(df))]
-
-        self.texts = [Dataset.tokenizer(text,
-                                padding='max_length',
-                                max_length=_max_length,
-                                truncation=True,
-                                return_tensors="pt") for text in df['string']]
+            self.labels = torch.zeros(len(df), dtype=torch.long)
+
+        # the tokenized strings are only cached when a cache_dir is given, which
+        # we do for the reference set since it is re-used by every replicate
+        strings = list(df['string'])
+        cache = None
+        if not cache_dir is None:
+            cache = Dataset.cache_path(cache_dir, strings, _max_length)
+
+        if not cache is None and os.path.exists(cache):
+            print(f"Loading tokenized strings from cache at {cache}")
+            cached = torch.load(cache, mmap=True)
+            self.input_ids = cached['ids']
+            self.offsets = cached['offsets']
+        else:
+            # tokenize all of the strings in a single call so the fast tokenizer
+            # can work across the whole batch instead of one string at a time,
+            # padding is left to the collator so each batch is only padded to
+            # its own longest example
+            encoded = Dataset.tokenizer(strings,
+                                    padding=False,
+                                    max_length=_max_length,
+                                    truncation=True)
+
+            # the variable length examples are stored back to back in one
+            # tensor, example i is input_ids[offsets[i]:offsets[i+1]]
+            lengths = torch.LongTensor([len(ids) for ids in encoded['input_ids']])
+            self.offsets = torch.zeros(len(lengths)+1, dtype=torch.long)
+            self.offsets[1:] = torch.cumsum(lengths, 0)
+            # int32 is plenty for the vocabulary and halves the bytes copied to the gpu
+            self.input_ids = torch.from_numpy(np.fromiter(itertools.chain.from_iterable(encoded['input_ids']), dtype=np.int32, count=int(self.offsets[-1])))
+
+            if not cache is None:
+                # write to a temporary file first so that concurrent runs
+                # never load a partially written cache file
+                os.makedirs(cache_dir, exist_ok=True)
+                tmp_cache = f'{cache}.{os.getpid()}.tmp'
+                torch.save({'ids': self.input_ids, 'offsets': self.offsets}, tmp_cache)
+                os.replace(tmp_cache, cache)
+
+        self.pad_token_id = Dataset.tokenizer.pad_token_id
 
     def classes(self):
         return self.labels
 
+    def lengths(self):
+        # number of tokens in each example
+        return self.offsets[1:] - self.offsets[:-1]
+
     def __len__(self):
         return len(self.labels)
 
     def get_batch_labels(self, idx):
         # Fetch a batch of labels
-        return np.array(self.labels[idx])
+        return self.labels[idx]
 
     def get_batch_texts(self, idx):
-        return self.texts[idx]
+        return self.input_ids[self.offsets[idx]:self.offsets[idx+1]]
 
     def __getitem__(self, idx):
 
@@ -71,27 +123,227 @@ class Dataset(torch.utils.data.Dataset):
 
         return batch_texts, batch_y
 
+    def collate(self, features):
+        # pads the batch to its longest example (rounded up to a multiple of 8
+        # for the tensor cores) and returns ((input_ids, attention_mask), labels),
+        # everything stays in int32 tensors and the labels are stacked directly
+        texts, batch_labels = zip(*features)
+        lengths = torch.LongTensor([len(text) for text in texts])
+        padded_length = 8*int(np.ceil(lengths.max().item()/8))
+
+        input_ids = nn.utils.rnn.pad_sequence(texts, batch_first=True, padding_value=self.pad_token_id)
+        input_ids = nn.functional.pad(input_ids, (0, padded_length-input_ids.shape[1]), value=self.pad_token_id)
+        attention_mask = (torch.arange(padded_length)[None, :] < lengths[:, None]).to(torch.int32)
+
+        return (input_ids, attention_mask), torch.stack(batch_labels)
+
+class BucketBatchSampler(torch.utils.data.Sampler):
+
+    # Yields batches of examples with similar token lengths so that dynamic
+    # padding wastes as little as possible. The examples are shuffled, split
+    # into windows of bucket_size*batch_size examples, sorted by length within
+    # each window, and then the resulting batches are shuffled.
+
+    def __init__(self, lengths, batch_size, bucket_size=50):
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.window = bucket_size*batch_size
+
+    def __iter__(self):
+        order = torch.randperm(len(self.lengths))
+        batches = list()
+        for window in torch.split(order, self.window):
+            window = window[torch.argsort(self.lengths[window], stable=True)]
+            batches.extend(torch.split(window, self.batch_size))
+
+        for i in torch.randperm(len(batches)):
+            yield batches[i].tolist()
+
+    def __len__(self):
+        n = len(self.lengths)
+        full_windows, remainder = divmod(n, self.window)
+        return full_windows*int(np.ceil(self.window/self.batch_size)) + int(np.ceil(remainder/self.batch_size))
+
 class ClinicalBertClassifier(nn.Module):
 
-    def __init__(self, pretrained_model_path, dropout=0.5):
+    def __init__(self, pretrained_model_path, dropout=0.5, frozen_layers=0, use_pooler=False, relu_output=False, gradient_checkpointing=False):
 
         super(ClinicalBertClassifier, self).__init__()
 
-        self.bert = AutoModel.from_pretrained(pretrained_model_path)
+        # by default the [CLS] hidden state is used directly, so the pooler (an
+        # extra dense + tanh layer) is never built. Models that were trained on
+        # the pooler output (see uses_pooler) need use_pooler=True to load.
+        # Self-attention goes through torch's scaled_dot_product_attention,
+        # which dispatches to the fused flash/memory-efficient kernels when
+        # running in float16.
+        # Those legacy models also had a ReLU on their logits (relu_output=True),
+        # the thresholds in create_onsides_datafiles.py were tuned on those scores.
+        self.use_pooler = use_pooler
+        self.relu_output = relu_output
+        self.bert = AutoModel.from_pretrained(pretrained_model_path, add_pooling_layer=use_pooler, attn_implementation='sdpa')
+
+        # optionally recompute the encoder activations during the backward pass
+        # instead of keeping them in memory, this costs extra compute and only
+        # pays off when the freed memory is spent on a larger batch size.
+        # non-reentrant checkpointing is needed because frozen embeddings
+        # produce outputs that do not require grad
+        if gradient_checkpointing:
+            self.bert.gradient_checkpointing_enable(gradient_checkpointing_kwargs={'use_reentrant': False})
+            self.bert.config.use_cache = False
+
+        # optionally only fine-tune the top encoder layers, the embeddings and
+        # the bottom frozen_layers encoder layers keep their pretrained weights
+        if frozen_layers > 0:
+            self.bert.embeddings.requires_grad_(False)
+        for name, param in self.bert.named_parameters():
+            if name.startswith('encoder.layer.'):
+                layer = int(name.split('encoder.layer.')[1].split('.')[0])
+                param.requires_grad = layer >= frozen_layers
         self.dropout = nn.Dropout(dropout)
         self.linear = nn.Linear(768, 2)
-        self.relu = nn.ReLU()
 
     def forward(self, input_id, mask):
 
-        _, pooled_output = self.bert(input_ids=input_id, attention_mask=mask, return_dict=False)
-        dropout_output = self.dropout(pooled_output)
-        linear_output = self.linear(dropout_output)
-        final_layer = self.relu(linear_output)
-
-        return final_layer
-
-def train(model, train_data, val_data, learning_rate, epochs, max_length, batch_size, model_filename):
+        outputs = self.bert(input_ids=input_id, attention_mask=mask, return_dict=True)
+        dropout_output = self.dropout(self.pooled_output(outputs.last_hidden_state))
+
+        return self.final_output(dropout_output)
+
+    def pooled_output(self, hidden_states):
+        if self.use_pooler:
+            return self.bert.pooler(hidden_states)
+        return hidden_states[:, 0]
+
+    def final_output(self, pooled_output):
+        # raw logits, CrossEntropyLoss applies the (log) softmax itself
+        logits = self.classify(self.linear, pooled_output)
+        if self.relu_output:
+            logits = torch.relu(logits)
+        return logits
+
+    def classify(self, head, pooled_output):
+        # the classifier head always runs in float32, even under autocast, so
+        # the saved scores are not rounded to float16 (the thresholds applied
+        # to them in create_onsides_datafiles.py are fine grained)
+        with torch.autocast('cuda', enabled=False):
+            return head(pooled_output.float())
+
+class EarlyExitClinicalBertClassifier(ClinicalBertClassifier):
+
+    # Adds classifier heads after some of the intermediate encoder layers
+    # (after layers 4 and 8 by default). They are trained along with the
+    # final head and, in evaluate, an example stops going through the
+    # encoder as soon as one of the heads is confident about it (entropy of
+    # its prediction below entropy_threshold).
+
+    def __init__(self, pretrained_model_path, dropout=0.5, frozen_layers=0, use_pooler=False, relu_output=False, gradient_checkpointing=False, exit_layers=(3, 7), entropy_threshold=0.1):
+
+        super(EarlyExitClinicalBertClassifier, self).__init__(pretrained_model_path, dropout, frozen_layers, use_pooler, relu_output, gradient_checkpointing)
+
+        self.exit_layers = list(exit_layers)
+        self.entropy_threshold = entropy_threshold
+        self.exits = nn.ModuleList([nn.Linear(768, 2) for _ in self.exit_layers])
+
+    def forward(self, input_id, mask, all_exits=False):
+
+        if not all_exits:
+            return super(EarlyExitClinicalBertClassifier, self).forward(input_id, mask)
+
+        # logits from each of the exit heads followed by the final head,
+        # hidden_states[0] is the embedding output so layer i is at i+1
+        outputs = self.bert(input_ids=input_id, attention_mask=mask, output_hidden_states=True, return_dict=True)
+        exit_outputs = [self.classify(head, self.dropout(outputs.hidden_states[layer+1][:, 0])) for layer, head in zip(self.exit_layers, self.exits)]
+        final_output = self.final_output(self.dropout(self.pooled_output(outputs.last_hidden_state)))
+
+        return exit_outputs + [final_output]
+
+    def predict_early_exit(self, input_id, mask):
+
+        # the heads are not calibrated against each other, so their raw logits
+        # are not comparable. Every example gets the softmax probabilities from
+        # the head that answered for it, which puts them all on one scale.
+        probs = torch.empty((input_id.shape[0], 2), device=input_id.device)
+        active = torch.arange(input_id.shape[0], device=input_id.device)
+        hidden = self.bert.embeddings(input_ids=input_id)
+        extended_mask = self.bert.get_extended_attention_mask(mask, input_id.shape)
+        exits = dict(zip(self.exit_layers, self.exits))
+
+        for i, layer in enumerate(self.bert.encoder.layer):
+            hidden = layer(hidden, attention_mask=extended_mask)[0]
+            if not i in exits:
+                continue
+
+            log_probs = torch.log_softmax(self.classify(exits[i], hidden[:, 0]), dim=1)
+            entropy = -(log_probs.exp()*log_probs).sum(dim=1)
+            done = entropy < self.entropy_threshold
+
+            # the confident examples leave the batch, the rest continue on
+            # through the encoder as a smaller batch
+            probs[active[done]] = log_probs[done].exp()
+            active = active[~done]
+            hidden = hidden[~done]
+            extended_mask = extended_mask[~done]
+            if len(active) == 0:
+                return probs
+
+        probs[active] = torch.softmax(self.final_output(self.pooled_output(hidden)), dim=1)
+        return probs
+
+def trainable_state_dict(model):
+    # only the fine-tuned parameters are saved, the frozen ones are reloaded
+    # from the pretrained network when the model is constructed
+    trainable = {name for name, param in model.named_parameters() if param.requires_grad}
+    return {k: v for k, v in model.state_dict().items() if k in trainable}
+
+def load_trainable_state(model, model_filepath):
+    # counterpart to trainable_state_dict, the missing (frozen) parameters
+    # keep the values they were constructed with. Any trainable parameter
+    # that is missing means the file is incomplete or the model was built
+    # with different settings (e.g. frozen_layers) than it was trained with.
+    result = model.load_state_dict(torch.load(model_filepath), strict=False)
+    if len(result.unexpected_keys) > 0:
+        raise Exception(f"ERROR: The saved state at {model_filepath} has unexpected keys: {result.unexpected_keys}")
+
+    trainable = {name for name, param in model.named_parameters() if param.requires_grad}
+    missing = [k for k in result.missing_keys if k in trainable]
+    if len(missing) > 0:
+        raise Exception(f"ERROR: The saved state at {model_filepath} is missing trainable parameters: {missing}")
+
+def uses_pooler(model_filepath):
+    # models trained before the pooler was dropped, and any model fine-tuned
+    # from one of them, have the pooler weights in their saved state. These
+    # legacy models are built with use_pooler=True and relu_output=True.
+    return 'bert.pooler.dense.weight' in torch.load(model_filepath, map_location='cpu', mmap=True)
+
+def load_pretrained_state(model, pretrained_state):
+    state = torch.load(pretrained_state)
+    if not model.use_pooler:
+        state = {k: v for k, v in state.items() if not k.startswith('bert.pooler.')}
+    model.load_state_dict(state, strict=False)
+
+def dataloader_options(use_cuda, persistent_workers=True):
+    # Pinned memory lets the host to device copies run asynchronously
+    # (non_blocking=True) and the worker processes keep the next batches
+    # ready while the GPU is busy with the current one. The workers are
+    # started from a forkserver rather than forked from this process, which
+    # has already used the (multithreaded) fast tokenizer.
+    return {
+        'pin_memory': use_cuda,
+        'num_workers': min(8, max(2, (os.cpu_count() or 1)//2)),
+        'persistent_workers': persistent_workers,
+        'prefetch_factor': 4,
+        'multiprocessing_context': 'forkserver'
+    }
+
+def compile_model(model, use_cuda):
+    # torch.compile fuses the kernels of the BERT encoder layers, we only do
+    # this on the GPU where the generated Triton kernels are used. Batches are
+    # padded dynamically so the sequence length is compiled as a dynamic shape.
+    if not use_cuda:
+        return model
+    return torch.compile(model, mode='reduce-overhead', dynamic=True)
+
+def train(model, train_data, val_data, learning_rate, epochs, max_length, batch_size, model_filename, cache_dir=None):
 
     skip_training = False
     if epochs == 0:
@@ -100,23 +352,34 @@ def train(model, train_data, val_data, learning_rate, epochs, max_length, batch_
 
     model.train()
 
-    train, val = Dataset(train_data, _max_length=max_length), Dataset(val_data, _max_length=max_length)
-
-    train_dataloader = torch.utils.data.DataLoader(train, batch_size=batch_size, shuffle=True)
-    val_dataloader = torch.utils.data.DataLoader(val, batch_size=batch_size)
+    train, val = Dataset(train_data, _max_length=max_length, cache_dir=cache_dir), Dataset(val_data, _max_length=max_length, cache_dir=cache_dir)
 
     use_cuda = torch.cuda.is_available()
     device = torch.device("cuda" if use_cuda else "cpu")
 
+    train_dataloader = torch.utils.data.DataLoader(train, batch_sampler=BucketBatchSampler(train.lengths(), batch_size), collate_fn=train.collate, **dataloader_options(use_cuda))
+    val_dataloader = torch.utils.data.DataLoader(val, batch_size=batch_size, collate_fn=val.collate, **dataloader_options(use_cuda, persistent_workers=False))
+
     print(f"Using device: {device}")
 
     criterion = nn.CrossEntropyLoss()
-    optimizer = Adam(model.parameters(), lr=learning_rate)
 
     if use_cuda:
         model = model.cuda()
         criterion = criterion.cuda()
 
+    # the fused implementation needs the parameters to already be on the gpu
+    optimizer = Adam([p for p in model.parameters() if p.requires_grad], lr=learning_rate, fused=use_cuda)
+    # loss scaling keeps the float16 gradients from underflowing
+    scaler = torch.amp.GradScaler('cuda', enabled=use_cuda)
+
+    # the exit heads of an early exit model are trained along with the final head
+    early_exit = isinstance(model, EarlyExitClinicalBertClassifier)
+
+    # checkpoints are saved from the uncompiled model so that the state_dict
+    # keys stay the same
+    compiled_model = compile_model(model, use_cuda)
+
     best_val_loss = None
     train_accuracies = list()
     train_losses = list()
@@ -128,57 +391,71 @@ def train(model, train_data, val_data, learning_rate, epochs, max_length, batch_
 
     for epoch_num in range(epochs):
 
-        total_acc_train = 0
-        total_loss_train = 0
+        # accumulate on the device and only sync with the host once per epoch
+        loss_sum_train = torch.zeros((), device=device)
+        acc_sum_train = torch.zeros((), device=device, dtype=torch.long)
         saved_model = False
         epoch_start_time = time.time()
         epochs_since_best += 1
 
-        for train_input, train_label in tqdm(train_dataloader):
+        for (train_input_ids, train_mask), train_label in tqdm(train_dataloader):
             if skip_training:
                 break
 
-            train_label = train_label.to(device)
-            mask = train_input['attention_mask'].to(device)
-            input_id = train_input['input_ids'].squeeze(1).to(device)
+            train_label = train_label.to(device, non_blocking=True)
+            mask = train_mask.to(device, non_blocking=True)
+            input_id = train_input_ids.to(device, non_blocking=True)
 
-            output = model(input_id, mask)
+            with torch.autocast('cuda', dtype=torch.float16, enabled=use_cuda):
+                if early_exit:
+                    *exit_outputs, output = compiled_model(input_id, mask, all_exits=True)
+                    final_loss = criterion(output, train_label)
+                    batch_loss = final_loss + sum(criterion(exit_output, train_label) for exit_output in exit_outputs)
+                else:
+                    output = compiled_model(input_id, mask)
+                    final_loss = batch_loss = criterion(output, train_label)
 
-            batch_loss = criterion(output, train_label)
-            total_loss_train += batch_loss.item()
+            # the reported loss is always that of the final head
+            loss_sum_train += final_loss.detach()
+            acc_sum_train += (output.argmax(dim=1) == train_label).sum()
 
-            acc = (output.argmax(dim=1) == train_label).sum().item()
-            total_acc_train += acc
+            optimizer.zero_grad(set_to_none=True)
+            scaler.scale(batch_loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
 
-            model.zero_grad()
-            batch_loss.backward()
-            optimizer.step()
+        total_loss_train = loss_sum_train.item()
+        total_acc_train = acc_sum_train.item()
 
-        total_acc_val = 0
-        total_loss_val = 0
+        loss_sum_val = torch.zeros((), device=device)
+        acc_sum_val = torch.zeros((), device=device, dtype=torch.long)
 
         with torch.no_grad():
 
-            for val_input, val_label in val_dataloader:
+            for (val_input_ids, val_mask), val_label in val_dataloader:
 
-                val_label = val_label.to(device)
-                mask = val_input['attention_mask'].to(device)
-                input_id = val_input['input_ids'].squeeze(1).to(device)
+                val_label = val_label.to(device, non_blocking=True)
+                mask = val_mask.to(device, non_blocking=True)
+                input_id = val_input_ids.to(device, non_blocking=True)
 
-                output = model(input_id, mask)
+                with torch.autocast('cuda', dtype=torch.float16, enabled=use_cuda):
+                    output = compiled_model(input_id, mask)
+                    batch_loss = criterion(output, val_label)
 
-                batch_loss = criterion(output, val_label)
-                total_loss_val += batch_loss.item()
+                loss_sum_val += batch_loss
+                acc_sum_val += (output.argmax(dim=1) == val_label).sum()
 
-                acc = (output.argmax(dim=1) == val_label).sum().item()
-                total_acc_val += acc
+        total_loss_val = loss_sum_val.item()
+        total_acc_val = acc_sum_val.item()
 
-            if best_val_loss is None or (total_loss_val/len(val_data)) < best_val_loss:
-                # best epoch so far, we save it to file
-                best_val_loss = (total_loss_val/len(val_data))
-                torch.save(model.state_dict(), model_filename)
-                saved_model = True
-                epochs_since_best = 0
+        # checkpoint at most once per epoch, after the whole validation set
+        # has been scored
+        if best_val_loss is None or (total_loss_val/len(val_data)) < best_val_loss:
+            # best epoch so far, we save it to file
+            best_val_loss = (total_loss_val/len(val_data))
+            torch.save(trainable_state_dict(model), model_filename, _use_new_zipfile_serialization=True, pickle_protocol=4)
+            saved_model = True
+            epochs_since_best = 0
 
         train_losses.append(total_loss_train / len(train_data))
         train_accuracies.append(total_acc_train / len(train_data))
@@ -199,47 +476,68 @@ def train(model, train_data, val_data, learning_rate, epochs, max_length, batch_
 
     return train_losses, train_accuracies, valid_losses, valid_accuracies, epoch_times, epoch_saved
 
-def evaluate(model, test_data, max_length, batch_size, examples_only=False):
+def evaluate(model, test_data, max_length, batch_size, examples_only=False, cache_dir=None):
 
     model.eval()
 
-    test = Dataset(test_data, examples_only, _max_length=max_length)
-
-    test_dataloader = torch.utils.data.DataLoader(test, batch_size=batch_size)
+    test = Dataset(test_data, examples_only, _max_length=max_length, cache_dir=cache_dir)
 
     use_cuda = torch.cuda.is_available()
     device = torch.device("cuda" if use_cuda else "cpu")
 
+    test_dataloader = torch.utils.data.DataLoader(test, batch_size=batch_size, collate_fn=test.collate, **dataloader_options(use_cuda, persistent_workers=False))
+
     if use_cuda:
 
         model = model.cuda()
 
-    total_acc_test = 0
+    # early exit models are always scored the way they are deployed, labeled
+    # sets included, so that the accuracy and the thresholds tuned on the
+    # valid/test outputs apply to the example predictions. This runs the
+    # encoder layer by layer so it is not compiled, and the outputs are
+    # softmax probabilities rather than logits.
+    early_exit = isinstance(model, EarlyExitClinicalBertClassifier)
+    if not early_exit:
+        model = compile_model(model, use_cuda)
+
+    acc_sum_test = torch.zeros((), device=device, dtype=torch.long)
     outputs = list()
 
     with torch.no_grad():
 
-        for test_input, test_label in tqdm(test_dataloader):
+        for (test_input_ids, test_mask), test_label in tqdm(test_dataloader):
 
-              test_label = test_label.to(device)
-              mask = test_input['attention_mask'].to(device)
-              input_id = test_input['input_ids'].squeeze(1).to(device)
+              test_label = test_label.to(device, non_blocking=True)
+              mask = test_mask.to(device, non_blocking=True)
+              input_id = test_input_ids.to(device, non_blocking=True)
+
+              with torch.autocast('cuda', dtype=torch.float16, enabled=use_cuda):
+                  if early_exit:
+                      output = model.predict_early_exit(input_id, mask)
+                  else:
+                      output = model(input_id, mask)
 
-              output = model(input_id, mask)
               outputs.append(output)
 
-              acc = (output.argmax(dim=1) == test_label).sum().item()
-              total_acc_test += acc
+              acc_sum_test += (output.argmax(dim=1) == test_label).sum()
+
+    total_acc_test = acc_sum_test.item()
 
     if not examples_only:
         print(f'Test Accuracy: {total_acc_test / len(test_data): .4f}')
 
     return outputs
 
-def batch_size_estimate(max_length):
+def batch_size_estimate(max_length, gradient_checkpointing=False):
     log_bs = -1.2209302325581395*np.log(max_length)+10.437506963082898
     bs = np.exp(log_bs)
     power = np.log2(bs)
+    # the fit above was made without gradient checkpointing, with it the
+    # activations take a fraction of the memory and we can double the batch.
+    # The default stays the original estimate since experiment_tracker.py
+    # uses it to reconstruct the filenames of existing models.
+    if gradient_checkpointing:
+        power += 1
     return 2**round(power)
 
 def split_train_val_test(df, np_random_seed):
@@ -255,9 +553,20 @@ def split_train_val_test(df, np_random_seed):
     print(f"Split labels in train, val, test by drug:")
     print(len(drugs_train), len(drugs_val), len(drugs_test))
 
-    df_train = df[df['drug'].isin(drugs_train)]
-    df_val = df[df['drug'].isin(drugs_val)]
-    df_test = df[df['drug'].isin(drugs_test)]
+    # label each row with its split in a single pass over the drug column,
+    # the split is looked up once per distinct drug and then gathered by the
+    # categorical codes (the caller's dataframe is left untouched)
+    split_id = {drug: 0 for drug in drugs_train}
+    split_id.update({drug: 1 for drug in drugs_val})
+    split_id.update({drug: 2 for drug in drugs_test})
+
+    drugs = df['drug'].astype('category')
+    code_to_split = np.array([split_id.get(drug, -1) for drug in drugs.cat.categories], dtype=np.int8)
+    row_split = code_to_split[drugs.cat.codes.to_numpy()]
+
+    df_train = df.iloc[row_split == 0]
+    df_val = df.iloc[row_split == 1]
+    df_test = df.iloc[row_split == 2]
 
     return df_train, df_val, df_test
 
@@ -292,6 +601,21 @@ def parse_network_argument(args_network):
 
     return network_code, network_path, pretrained_state
 
+def parse_network_code(network_code):
+    # splits off the suffixes that --frozen-layers (F{n}) and --early-exit (EE)
+    # add to the network code, e.g. CB0F8EE -> ('CB0', 8, True)
+    early_exit = network_code.endswith('EE')
+    if early_exit:
+        network_code = network_code[:-len('EE')]
+
+    frozen_layers = 0
+    match = re.search(r'F(\d+)$', network_code)
+    if not match is None:
+        frozen_layers = int(match.group(1))
+        network_code = network_code[:match.start()]
+
+    return network_code, frozen_layers, early_exit
+
 
 if __name__ == '__main__':
 
@@ -304,6 +628,9 @@ if __name__ == '__main__':
     parser.add_argument('--ifexists', help="what to do if model already exists with same parameters, options are 'replicate', 'overwrite', 'quit' - default is 'quit'", type=str, default='quit')
     parser.add_argument('--network', help="path to pretained network, default is 'models/Bio_ClinicalBERT', but you can use other pretrained models or you can use previously saved states.", type=str, default='models/Bio_ClinicalBERT/')
     parser.add_argument('--base-dir', type=str, default='.')
+    parser.add_argument('--frozen-layers', help="number of bottom encoder layers (and the embeddings) to freeze during fine-tuning, default is 0 (fine-tune the whole network), a non-zero value adds F{n} to the network code in the model filenames", type=int, default=0)
+    parser.add_argument('--gradient-checkpointing', help="recompute the encoder activations during the backward pass to save memory, use together with a larger --batch-size (about 2X the default estimate)", action='store_true', default=False)
+    parser.add_argument('--early-exit', help="train additional classifier heads on intermediate encoder layers so that confident predictions on examples can exit early, adds EE to the network code in the model filenames", action='store_true', default=False)
 
     args = parser.parse_args()
 
@@ -331,6 +658,14 @@ if __name__ == '__main__':
 
     network_code, network_path, pretrained_state = parse_network_argument(args.network)
 
+    if args.frozen_layers > 0:
+        network_code += f'F{args.frozen_layers}'
+
+    model_class = ClinicalBertClassifier
+    if args.early_exit:
+        model_class = EarlyExitClinicalBertClassifier
+        network_code += 'EE'
+
     if args.max_length == -1:
         # Default option, we set it to smallest power of two greater than
         # 2*nwords in the reference set. In our analysis we found that
@@ -352,9 +687,11 @@ if __name__ == '__main__':
         # NOTE: This is machine dependent! We are using P100s with 16GB of memory
         batch_size = batch_size_estimate(max_length)
         print(f" Based on the max_length, we are estimating that a batch_size of {batch_size} is the largest that will not run into memory issues.")
+        if args.gradient_checkpointing:
+            print(f" With gradient checkpointing a batch_size of up to {batch_size_estimate(max_length, gradient_checkpointing=True)} should fit, pass it with --batch-size to use it.")
     else:
         batch_size = args.batch_size
-        est_batch_size = batch_size_estimate(max_length)
+        est_batch_size = batch_size_estimate(max_length, gradient_checkpointing=args.gradient_checkpointing)
         if batch_size > est_batch_size:
             print(f" WARNING: the provided batch size ({batch_size}) is greater than what we would estimate ({est_batch_size}) will work. You may run into memory issues. If so, reduce the batch size or use the default option value.")
 
@@ -368,7 +705,7 @@ if __name__ == '__main__':
             sys.exit(1)
         elif args.ifexists == 'replicate':
             print("  Will run a replicate, checking for any existing replicates...")
-            reps = [f for f in os.listdir(f'{args.base_dir}/models/') if f.find(filename_params) != -1 and f.lower().find('bestepoch') == -1]
+            reps = [f for f in os.listdir(f'{args.base_dir}/models/') if f.find(f'-{network_code}_{filename_params}') != -1 and f.lower().find('bestepoch') == -1]
             filename_params = f'{filename_params}_rep{len(reps)}'
             final_model_filename = f'{args.base_dir}/models/final-bydrug-{network_code}_{filename_params}.pth'
             print(f"    Found {len(reps)} existing models. Filename for this replicate will be: {final_model_filename}")
@@ -390,20 +727,23 @@ if __name__ == '__main__':
     Dataset.set_tokenizer(network_path)
 
     # now we can initailize a model
-    model = ClinicalBertClassifier(network_path)
+    # warm starting from a legacy model (pooler output and ReLU'd logits) keeps its head
+    use_pooler = not pretrained_state is None and uses_pooler(pretrained_state)
+    model = model_class(network_path, frozen_layers=args.frozen_layers, use_pooler=use_pooler, relu_output=use_pooler, gradient_checkpointing=args.gradient_checkpointing)
 
     if not pretrained_state is None:
         print(f"Loading pretrained state from model at: {pretrained_state}")
-        model.load_state_dict(torch.load(pretrained_state))
+        load_pretrained_state(model, pretrained_state)
 
     print("Fitting the model...")
     best_epoch_model_filename = f'{args.base_dir}/models/bestepoch-bydrug-{network_code}_{filename_params}.pth'
 
-    training_results = train(model, df_train, df_val, LR, EPOCHS, max_length, batch_size, best_epoch_model_filename)
+    cache_dir = f'{args.base_dir}/cache'
+    training_results = train(model, df_train, df_val, LR, EPOCHS, max_length, batch_size, best_epoch_model_filename, cache_dir)
 
     print("Saving the model to file...")
 
-    torch.save(model.state_dict(), final_model_filename)
+    torch.save(trainable_state_dict(model), final_model_filename, _use_new_zipfile_serialization=True, pickle_protocol=4)
 
     print("Saving loss and accuracies for each epoch to file...")
     lafh = open(f'{args.base_dir}/results/epoch-results-{network_code}_{filename_params}.csv', 'w')
@@ -415,8 +755,17 @@ if __name__ == '__main__':
 
     print("Loading the model from file...")
 
-    loaded_model = ClinicalBertClassifier(network_path)
-    loaded_model.load_state_dict(torch.load(final_model_filename))
+    loaded_model = model_class(network_path, frozen_layers=args.frozen_layers, use_pooler=use_pooler, relu_output=use_pooler)
+    if not pretrained_state is None:
+        # the frozen layers come from the pretrained state, not the network
+        load_pretrained_state(loaded_model, pretrained_state)
+    load_trainable_state(loaded_model, final_model_filename)
+
+    if not torch.cuda.is_available():
+        # on the cpu we run inference with int8 weights for the linear layers,
+        # this is cheap to redo so the quantized model is not saved
+        print("No GPU available, quantizing the linear layers of the model to int8...")
+        loaded_model = torch.ao.quantization.quantize_dynamic(loaded_model, {nn.Linear}, dtype=torch.qint8)
 
     print("Evaluating the model on the held out test set...")
-    evaluate(loaded_model, df_test, max_length, batch_size)
+    evaluate(loaded_model, df_test, max_length, batch_size, cache_dir=cache_dir)
@@ -68,12 +68,14 @@ if __name__ == '__main__':
     max_length = int(model_file_noext.split('_')[6])
     batch_size = int(model_file_noext.split('_')[7])
     prefix = model_file_noext.split('_')[0]
-    network = prefix.split('-')[2]
+    network, frozen_layers, early_exit = cb.parse_network_code(prefix.split('-')[2])
 
     print(f"Model")
     print(f"-------------------")
     print(f" prefix: {prefix}")
     print(f" network: {network}")
+    print(f" frozen_layers: {frozen_layers}")
+    print(f" early_exit: {early_exit}")
     print(f" refset: {refset}")
     print(f" refsection: {refsection}")
     print(f" refnwords: {refnwords}")
@@ -134,8 +136,13 @@ if __name__ == '__main__':
     # initailize Dataset.tokenizer
     cb.Dataset.set_tokenizer(network_path)
 
-    model = cb.ClinicalBertClassifier(network_path)
-    model.load_state_dict(torch.load(model_filepath))
+    # legacy models keep their original head (pooler output and ReLU'd logits)
+    use_pooler = cb.uses_pooler(model_filepath)
+    if early_exit:
+        model = cb.EarlyExitClinicalBertClassifier(network_path, frozen_layers=frozen_layers, use_pooler=use_pooler, relu_output=use_pooler)
+    else:
+        model = cb.ClinicalBertClassifier(network_path, frozen_layers=frozen_layers, use_pooler=use_pooler, relu_output=use_pooler)
+    cb.load_trainable_state(model, model_filepath)
 
     # loading the example data
     df = pd.read_csv(args.examples)